@@ -86,7 +86,11 @@ def config():
         "--batch-size",
         type=int,
         default=50,
-        help=("Specify number of items to process in each batch."),
+        help=(
+            "Specify number of items to process in each batch. Batches of at "
+            "least 32 items are re-encrypted on one worker process per usable "
+            "CPU, in chunks of at least 16 items."
+        ),
     )
     parser.add_argument(
         "--allow-missing-wallet",
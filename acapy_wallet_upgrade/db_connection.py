@@ -1,5 +1,15 @@
 from abc import ABC, abstractmethod
-from typing import AsyncIterator, Optional, Sequence, Tuple, Union
+from typing import AsyncIterator, NamedTuple, Optional, Sequence, Tuple, Union
+
+
+class UpdatedItem(NamedTuple):
+    """An item re-encrypted with the Askar profile key."""
+
+    id: int
+    category: bytes
+    name: bytes
+    value: bytes
+    tags: Sequence[Tuple[int, bytes, bytes]]
 
 
 class DbConnection(ABC):
@@ -51,5 +61,5 @@ class Wallet(ABC):
         """Fetch un-updated items."""
 
     @abstractmethod
-    async def update_items(self, items):
+    async def update_items(self, items: Sequence[UpdatedItem]):
         """Update items in the database."""
@@ -1,3 +1,4 @@
+import asyncio
 import base64
 from typing import Optional
 from urllib.parse import urlparse
@@ -192,6 +193,9 @@ class PgWallet(Wallet):
         self._items_table = items_table
         self._wallet_id = wallet_id
         self._profile_id = None
+        # Reads and writes may be issued concurrently, but both use the old
+        # connection, which can only run one operation at a time
+        self._conn_lock = asyncio.Lock()
 
     @property
     def profile_id(self):
@@ -235,6 +239,7 @@ class PgWallet(Wallet):
 
     async def fetch_pending_items(self, batch_size: int):
         """Fetch un-updated items by wallet_id, if it exists."""
+        last_id = 0
         while True:
             command = """
                     SELECT i.id, i.type, i.name, i.value, i.key,
@@ -245,45 +250,49 @@ class PgWallet(Wallet):
                     """  # noqa
             if self._wallet_id:
                 command += (
-                    f"FROM {self._items_table} i WHERE i.wallet_id = $2 LIMIT $1;"
-                )
-                rows = await self._old_conn.fetch(
-                    command,
-                    batch_size,
-                    self._wallet_id,
+                    f"FROM {self._items_table} i WHERE i.id > $2 AND i.wallet_id = $3 "
+                    "ORDER BY i.id LIMIT $1;"
                 )
+                args = (batch_size, last_id, self._wallet_id)
             else:
-                command += f"FROM {self._items_table} i LIMIT $1;"
-                rows = await self._old_conn.fetch(command, batch_size)
+                command += (
+                    f"FROM {self._items_table} i WHERE i.id > $2 "
+                    "ORDER BY i.id LIMIT $1;"
+                )
+                args = (batch_size, last_id)
+            async with self._conn_lock:
+                rows = await self._old_conn.fetch(command, *args)
             if not rows:
                 break
+            last_id = rows[-1][0]
             yield rows
 
     async def update_items(self, items):
         """Update items in the database."""
         del_ids = []
-        for item in items:
-            del_ids = item["id"]
-            async with self._new_conn.transaction():
-                ins = await self._new_conn.fetch(
+        tags = []
+        async with self._conn_lock, self._new_conn.transaction():
+            for item in items:
+                del_ids.append(item.id)
+                item_id = await self._new_conn.fetchval(
                     """
                         INSERT INTO items (profile_id, kind, category, name, value)
                         VALUES ($1, 2, $2, $3, $4) RETURNING id
                     """,
                     self._profile_id or 1,
-                    item["category"],
-                    item["name"],
-                    item["value"],
+                    item.category,
+                    item.name,
+                    item.value,
                 )
-                item_id = ins[0][0]
-                if item["tags"]:
-                    await self._new_conn.executemany(
-                        """
-                            INSERT INTO items_tags (item_id, plaintext, name, value)
-                            VALUES ($1, $2, $3, $4)
-                        """,
-                        ((item_id, *tag) for tag in item["tags"]),
-                    )
-                await self._old_conn.execute(
-                    f"DELETE FROM {self._items_table} WHERE id IN ($1)", del_ids
+                tags.extend((item_id, *tag) for tag in item.tags)
+            if tags:
+                await self._new_conn.executemany(
+                    """
+                        INSERT INTO items_tags (item_id, plaintext, name, value)
+                        VALUES ($1, $2, $3, $4)
+                    """,
+                    tags,
                 )
+            await self._old_conn.execute(
+                f"DELETE FROM {self._items_table} WHERE id = ANY($1)", del_ids
+            )
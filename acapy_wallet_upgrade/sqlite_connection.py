@@ -163,6 +163,7 @@ class SqliteWallet(Wallet):
 
     async def fetch_pending_items(self, batch_size: int):
         """Fetch un-updated items."""
+        last_id = 0
         while True:
             stmt = await self._conn.execute(
                 """
@@ -171,36 +172,39 @@ class SqliteWallet(Wallet):
                     FROM tags_encrypted te WHERE te.item_id = i.id) AS tags_enc,
                 (SELECT GROUP_CONCAT(HEX(tp.name) || ':' || HEX(tp.value))
                     FROM tags_plaintext tp WHERE tp.item_id = i.id) AS tags_plain
-                FROM items_old i LIMIT ?1
+                FROM items_old i WHERE i.id > ?2 ORDER BY i.id LIMIT ?1
                 """,
-                (batch_size,),
+                (batch_size, last_id),
             )
             rows = await stmt.fetchall()
             if not rows:
                 break
+            last_id = rows[-1][0]
             yield rows
 
     async def update_items(self, items):
         """Update items in the database."""
         del_ids = []
+        tags = []
         for item in items:
-            del_ids.append(item["id"])
+            del_ids.append(item.id)
             ins = await self._conn.execute(
                 """
                 INSERT INTO items (profile_id, kind, category, name, value)
                 VALUES (1, 2, ?1, ?2, ?3)
                 """,
-                (item["category"], item["name"], item["value"]),
+                (item.category, item.name, item.value),
             )
             item_id = ins.lastrowid
-            if item["tags"]:
-                await self._conn.executemany(
-                    """
-                    INSERT INTO items_tags (item_id, plaintext, name, value)
-                    VALUES (?1, ?2, ?3, ?4)
-                    """,
-                    ((item_id, *tag) for tag in item["tags"]),
-                )
+            tags.extend((item_id, *tag) for tag in item.tags)
+        if tags:
+            await self._conn.executemany(
+                """
+                INSERT INTO items_tags (item_id, plaintext, name, value)
+                VALUES (?1, ?2, ?3, ?4)
+                """,
+                tags,
+            )
         await self._conn.execute(
             "DELETE FROM items_old WHERE id IN ({})".format(
                 ",".join([str(del_id) for del_id in del_ids])
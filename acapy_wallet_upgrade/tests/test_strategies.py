@@ -0,0 +1,412 @@
+import hashlib
+import hmac
+import os
+import sqlite3
+import threading
+
+import nacl.bindings
+import pytest
+from aries_askar import Store
+from nacl.exceptions import CryptoError
+
+from acapy_wallet_upgrade import strategies
+from acapy_wallet_upgrade.error import UpgradeError
+from acapy_wallet_upgrade.sqlite_connection import SqliteConnection
+from acapy_wallet_upgrade.strategies import (
+    CHACHAPOLY_NONCE_LEN,
+    CHACHAPOLY_TAG_LEN,
+    DbpwStrategy,
+    Strategy,
+    U32_BE,
+    _hmac_sha256,
+)
+
+
+@pytest.mark.parametrize("key_len", [0, 16, 32, 64, 65, 100])
+def test_hmac_sha256(key_len):
+    key = os.urandom(key_len)
+    assert (
+        _hmac_sha256(key, b"one", b"", b"two")
+        == hmac.new(key, b"onetwo", hashlib.sha256).digest()
+    )
+
+
+def test_decrypt_tags():
+    name_key, value_key = os.urandom(32), os.urandom(32)
+    tags = [(b"one", b"1"), (b"two", b"")]
+    enc_tags = ",".join(
+        Strategy.encrypt_merged(name, name_key).hex()
+        + ":"
+        + Strategy.encrypt_merged(value, value_key).hex()
+        for name, value in tags
+    )
+    plain_tags = ",".join(
+        Strategy.encrypt_merged(name, name_key).hex() + ":" + value.hex()
+        for name, value in tags
+    )
+    assert list(Strategy.decrypt_tags(enc_tags, name_key, value_key)) == tags
+    assert list(Strategy.decrypt_tags(plain_tags, name_key)) == tags
+    with pytest.raises(UpgradeError):
+        list(Strategy.decrypt_tags(enc_tags + ",00", name_key, value_key))
+
+
+def test_credential_tags():
+    tags = Strategy._credential_tags(
+        {
+            "schema_id": "Th7MpTaRZVRYnPiabds81Y:2:schema name:1.0",
+            "cred_def_id": "Th7MpTaRZVRYnPiabds81Y:3:CL:12:tag",
+            "rev_reg_id": None,
+            "values": {
+                "first name": {"raw": "Alice", "encoded": "1"},
+                " date of birth ": {"raw": "19700101", "encoded": "19700101"},
+            },
+        },
+    )
+    assert tags == {
+        "schema_id": "Th7MpTaRZVRYnPiabds81Y:2:schema name:1.0",
+        "schema_issuer_did": "Th7MpTaRZVRYnPiabds81Y",
+        "schema_name": "schema name",
+        "schema_version": "1.0",
+        "issuer_did": "Th7MpTaRZVRYnPiabds81Y",
+        "cred_def_id": "Th7MpTaRZVRYnPiabds81Y:3:CL:12:tag",
+        "rev_reg_id": "None",
+        "attr::firstname::value": "Alice",
+        "attr::dateofbirth::value": "19700101",
+    }
+
+
+@pytest.mark.parametrize(
+    "schema_id, cred_def_id",
+    [
+        ("Th7MpTaRZVRYnPiabds81Y:2:name", "Th7MpTaRZVRYnPiabds81Y:3:CL:12:tag"),
+        ("Th7MpTaRZVRYnPiabds81Y:2:name:1.0", "Th7MpTaRZVRYnPiabds81Y:3:CL:12"),
+    ],
+)
+def test_credential_tags_invalid_ids(schema_id, cred_def_id):
+    with pytest.raises(UpgradeError):
+        Strategy._credential_tags(
+            {"schema_id": schema_id, "cred_def_id": cred_def_id, "values": {}}
+        )
+
+
+def test_encrypt_merged():
+    key, hmac_key = os.urandom(32), os.urandom(32)
+    enc = Strategy.encrypt_merged(b"message", key, hmac_key)
+    assert len(enc) == CHACHAPOLY_NONCE_LEN + len(b"message") + CHACHAPOLY_TAG_LEN
+    assert enc == Strategy.encrypt_merged(b"message", key, hmac_key)
+    assert (
+        enc[:CHACHAPOLY_NONCE_LEN]
+        == _hmac_sha256(hmac_key, b"message")[:CHACHAPOLY_NONCE_LEN]
+    )
+    assert (
+        nacl.bindings.crypto_aead_chacha20poly1305_ietf_decrypt(
+            enc[CHACHAPOLY_NONCE_LEN:], None, enc[:CHACHAPOLY_NONCE_LEN], key
+        )
+        == b"message"
+    )
+    assert Strategy.decrypt_merged(enc, key) == b"message"
+    with pytest.raises(CryptoError):
+        Strategy.decrypt_merged(enc, hmac_key)
+
+
+def test_encrypt_merged_nacl_fallback(monkeypatch):
+    pytest.importorskip("cryptography")
+    key, hmac_key = os.urandom(32), os.urandom(32)
+    enc_fast = Strategy.encrypt_merged(b"message", key, hmac_key)
+    monkeypatch.setattr(strategies, "ChaCha20Poly1305", None)
+    enc_nacl = Strategy.encrypt_merged(b"message", key, hmac_key)
+    assert enc_nacl == enc_fast
+    assert Strategy.decrypt_merged(enc_fast, key) == b"message"
+    with pytest.raises(CryptoError):
+        Strategy.decrypt_merged(enc_fast, hmac_key)
+    monkeypatch.undo()
+    assert Strategy.decrypt_merged(enc_nacl, key) == b"message"
+
+
+INDY_KEY_NAMES = (
+    "type",
+    "name",
+    "value",
+    "item_hmac",
+    "tag_name",
+    "tag_value",
+    "tag_hmac",
+)
+PROFILE_KEY_NAMES = ("ick", "ink", "ihk", "tnk", "tvk", "thk")
+
+
+@pytest.mark.parametrize(
+    "batch_size, cpus, workers", [(10, 4, 1), (50, 1, 1), (50, 4, 3), (500, 4, 4)]
+)
+def test_workers(monkeypatch, batch_size, cpus, workers):
+    monkeypatch.setattr(strategies, "_usable_cpus", lambda: cpus)
+    assert DbpwStrategy(None, "wallet", "key", batch_size).workers == workers
+
+
+def _generate_keys():
+    indy_key = {name: os.urandom(32) for name in INDY_KEY_NAMES}
+    profile_key = {name: os.urandom(32) for name in PROFILE_KEY_NAMES}
+    return indy_key, profile_key
+
+
+def _create_indy_wallet(path, indy_key: dict, count: int):
+    """Create an Indy SDK sqlite wallet holding count records."""
+    encrypt = Strategy.encrypt_merged
+    db = sqlite3.connect(path)
+    db.executescript(
+        """
+        CREATE TABLE metadata (id INTEGER PRIMARY KEY, value NOT NULL);
+        CREATE TABLE items (
+            id INTEGER PRIMARY KEY, type BLOB, name BLOB, value BLOB, key BLOB
+        );
+        CREATE TABLE tags_encrypted (name BLOB, value BLOB, item_id INTEGER);
+        CREATE TABLE tags_plaintext (name BLOB, value TEXT, item_id INTEGER);
+        """
+    )
+    for idx in range(count):
+        value_key = os.urandom(32)
+        item_id = db.execute(
+            "INSERT INTO items (type, name, value, key) VALUES (?, ?, ?, ?)",
+            (
+                encrypt(b"record", indy_key["type"], indy_key["item_hmac"]),
+                encrypt(b"rec%d" % idx, indy_key["name"], indy_key["item_hmac"]),
+                encrypt(b"value%d" % idx, value_key),
+                encrypt(value_key, indy_key["value"]),
+            ),
+        ).lastrowid
+        db.execute(
+            "INSERT INTO tags_encrypted VALUES (?, ?, ?)",
+            (
+                encrypt(b"enc", indy_key["tag_name"], indy_key["tag_hmac"]),
+                encrypt(b"e%d" % idx, indy_key["tag_value"], indy_key["tag_hmac"]),
+                item_id,
+            ),
+        )
+        db.execute(
+            "INSERT INTO tags_plaintext VALUES (?, ?, ?)",
+            (
+                encrypt(b"plain", indy_key["tag_name"], indy_key["tag_hmac"]),
+                b"p%d" % idx,
+                item_id,
+            ),
+        )
+    db.commit()
+    db.close()
+
+
+def _read_askar_items(path, profile_key: dict) -> dict:
+    """Decrypt the items of a migrated wallet, as {name: (value, tags)}."""
+    decrypt = Strategy.decrypt_merged
+    db = sqlite3.connect(path)
+    items = {}
+    for item_id, category, name, value in db.execute(
+        "SELECT id, category, name, value FROM items"
+    ):
+        category = decrypt(category, profile_key["ick"])
+        name = decrypt(name, profile_key["ink"])
+        value_key = _hmac_sha256(
+            profile_key["ihk"],
+            U32_BE.pack(len(category)),
+            category,
+            U32_BE.pack(len(name)),
+            name,
+        )
+        tags = set()
+        for plain, tag_name, tag_value in db.execute(
+            "SELECT plaintext, name, value FROM items_tags WHERE item_id = ?",
+            (item_id,),
+        ):
+            if not plain:
+                tag_value = decrypt(tag_value, profile_key["tvk"])
+            tags.add((decrypt(tag_name, profile_key["tnk"]), tag_value))
+        items[name] = (decrypt(value, value_key), tags)
+    db.close()
+    return items
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("batch_size, workers", [(50, 1), (50, 2), (200, 2)])
+async def test_update_items(tmp_path, batch_size, workers):
+    path = str(tmp_path / "wallet.db")
+    indy_key, profile_key = _generate_keys()
+    _create_indy_wallet(path, indy_key, 500)
+
+    conn = SqliteConnection(f"sqlite://{path}")
+    strategy = DbpwStrategy(conn, "wallet", "key", batch_size)
+    strategy.workers = workers
+    await conn.connect()
+    await conn.pre_upgrade()
+    with strategy.process_pool():
+        await strategy.update_items(conn.get_wallet(), indy_key, profile_key)
+    await conn.close()
+
+    items = _read_askar_items(path, profile_key)
+    assert len(items) == 500
+    for idx in range(500):
+        assert items[b"rec%d" % idx] == (
+            b"value%d" % idx,
+            {(b"enc", b"e%d" % idx), (b"plain", b"p%d" % idx)},
+        )
+
+
+@pytest.mark.asyncio
+async def test_update_items_overlap(tmp_path):
+    path = str(tmp_path / "wallet.db")
+    indy_key, profile_key = _generate_keys()
+    _create_indy_wallet(path, indy_key, 150)
+
+    conn = SqliteConnection(f"sqlite://{path}")
+    strategy = DbpwStrategy(conn, "wallet", "key", 50)
+    strategy.workers = 1
+    await conn.connect()
+    await conn.pre_upgrade()
+    wallet = conn.get_wallet()
+    update_items = wallet.update_items
+    first_written = threading.Event()
+    overlapped = []
+
+    async def write(items):
+        await update_items(items)
+        first_written.set()
+
+    def update_rows(rows, *args):
+        if rows[0][0] == 51:
+            # Only completes if the first batch is written meanwhile
+            overlapped.append(first_written.wait(5))
+        return Strategy.update_rows(rows, *args)
+
+    wallet.update_items = write
+    strategy.update_rows = update_rows
+    await strategy.update_items(wallet, indy_key, profile_key)
+    await conn.close()
+
+    assert overlapped == [True]
+    assert len(_read_askar_items(path, profile_key)) == 150
+
+
+@pytest.mark.asyncio
+async def test_update_items_failure(tmp_path):
+    path = str(tmp_path / "wallet.db")
+    indy_key, profile_key = _generate_keys()
+    _create_indy_wallet(path, indy_key, 250)
+    # Corrupt an item in the third batch
+    db = sqlite3.connect(path)
+    db.execute("UPDATE items SET key = ? WHERE id = 120", (os.urandom(60),))
+    db.commit()
+    db.close()
+
+    conn = SqliteConnection(f"sqlite://{path}")
+    strategy = DbpwStrategy(conn, "wallet", "key", 50)
+    await conn.connect()
+    await conn.pre_upgrade()
+    with pytest.raises(UpgradeError):
+        await strategy.update_items(conn.get_wallet(), indy_key, profile_key)
+    await conn.close()
+
+    items = _read_askar_items(path, profile_key)
+    assert sorted(items) == sorted(b"rec%d" % idx for idx in range(100))
+    db = sqlite3.connect(path)
+    assert db.execute("SELECT MIN(id), COUNT(*) FROM items_old").fetchone() == (
+        101,
+        150,
+    )
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_update_items_write_failure(tmp_path, caplog):
+    path = str(tmp_path / "wallet.db")
+    indy_key, profile_key = _generate_keys()
+    _create_indy_wallet(path, indy_key, 250)
+    db = sqlite3.connect(path)
+    db.execute("UPDATE items SET key = ? WHERE id = 120", (os.urandom(60),))
+    db.commit()
+    db.close()
+
+    conn = SqliteConnection(f"sqlite://{path}")
+    strategy = DbpwStrategy(conn, "wallet", "key", 50)
+    await conn.connect()
+    await conn.pre_upgrade()
+    wallet = conn.get_wallet()
+    update_items = wallet.update_items
+
+    async def fail_second_write(items):
+        if items[0].id > 50:
+            raise RuntimeError("write failed")
+        await update_items(items)
+
+    wallet.update_items = fail_second_write
+    # The write of the second batch fails while the third is being decrypted
+    with pytest.raises(UpgradeError):
+        await strategy.update_items(wallet, indy_key, profile_key)
+    await conn.close()
+
+    assert "Failed to write a batch of items" in caplog.text
+    assert "write failed" in caplog.text
+
+
+def test_update_rows_partial_failure():
+    indy_key, profile_key = _generate_keys()
+    rows = []
+    for idx in range(3):
+        value_key = os.urandom(32)
+        rows.append(
+            (
+                idx,
+                Strategy.encrypt_merged(b"category", indy_key["type"]),
+                Strategy.encrypt_merged(b"name%d" % idx, indy_key["name"]),
+                Strategy.encrypt_merged(b"value", value_key),
+                Strategy.encrypt_merged(value_key, indy_key["value"]),
+                None,
+                None,
+            )
+        )
+    rows[1] = rows[1][:4] + (os.urandom(60),) + rows[1][5:]
+
+    upd, err = Strategy.update_rows(rows, indy_key, profile_key, False)
+    assert [item.id for item in upd] == [0]
+    assert isinstance(err, CryptoError)
+
+
+@pytest.mark.asyncio
+async def test_batched_update_failure(tmp_path):
+    store = await Store.provision(
+        f"sqlite://{tmp_path / 'wallet.db'}", "raw", Store.generate_raw_key()
+    )
+    async with store.session() as session:
+        for idx in range(200):
+            await session.insert("Indy::CredentialDefinition", f"c{idx}", b"{}")
+            if idx != 123:
+                await session.insert("Indy::SchemaId", f"c{idx}", b"schema")
+
+    strategy = DbpwStrategy(None, "wallet", "key", 500)
+    with pytest.raises(Exception, match="Schema ID not found .*: c123$"):
+        await strategy.update_cred_defs(store)
+
+    async with store.session() as session:
+        assert await session.count("Indy::CredentialDefinition") == 200
+        assert await session.count("credential_def") == 0
+    await store.close()
+
+
+@pytest.mark.asyncio
+async def test_update_creds_stdlib_json(tmp_path):
+    store = await Store.provision(
+        f"sqlite://{tmp_path / 'wallet.db'}", "raw", Store.generate_raw_key()
+    )
+    # Accepted by the stdlib json module, but rejected by orjson
+    value = (
+        b'\xef\xbb\xbf{"schema_id": "Th7MpTaRZVRYnPiabds81Y:2:name:1.0",'
+        b' "cred_def_id": "Th7MpTaRZVRYnPiabds81Y:3:CL:12:tag",'
+        b' "values": {"name": {"raw": "Alice", "encoded": "1"}}, "score": NaN}'
+    )
+    async with store.session() as session:
+        await session.insert("Indy::Credential", "cred", value)
+
+    await DbpwStrategy(None, "wallet", "key", 50).update_creds(store)
+
+    async with store.session() as session:
+        cred = await session.fetch("credential", "cred")
+    assert cred.raw_value == value
+    assert cred.tags["attr::name::value"] == "Alice"
+    await store.close()